@@ -1 +1,29 @@
-from app import webserver
+import sys
+from app import webserver, start_tasks_runner
+
+# Only `python api_server.py` forks the workers and starts their thread pools; served any
+# other way (`flask --app api_server run`, `make run_server`) no job would ever be queued
+if webserver.num_workers > 1 and __name__ != '__main__':
+    sys.exit("SERVER_WORKERS > 1 needs the pre-forking server: run python api_server.py")
+
+# Server startup, both from `python api_server.py` and `flask --app api_server run`:
+# no job queued or running in a previous run will ever finish
+webserver.job_registry.fail_unfinished()
+
+if __name__ == '__main__':
+    import os
+    from app.prefork import serve
+
+    # SERVER_WORKERS=N python api_server.py serves from N pre-forked processes
+    if webserver.num_workers > 1:
+        # the parent answers and queues jobs while the dataset loads, then runs the
+        # queued jobs and stops its thread pool before forking
+        start_tasks_runner()
+        serve(webserver, webserver.num_workers,
+              (os.getenv('SERVER_HOST', '127.0.0.1'), int(os.getenv('SERVER_PORT', '5000'))),
+              start_tasks_runner,
+              warm_up=(webserver.data_ingestor.wait_ready,
+                       webserver.tasks_runner.graceful_shutdown))
+    else:
+        webserver.run(host=os.getenv('SERVER_HOST', '127.0.0.1'),
+                      port=int(os.getenv('SERVER_PORT', '5000')), threaded=True)
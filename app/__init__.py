@@ -2,18 +2,40 @@
 import os
 from flask import Flask
 from app.data_ingestor import DataIngestor
-from app.task_runner import ThreadPool
+from app.task_runner import ThreadPool, JOB_TYPES
+from app.profiler import JobProfiler
+from app.job_registry import JobRegistry
 
 webserver = Flask(__name__)
 
-if not os.path.exists('results'):
-    os.makedirs('results')
-webserver.tasks_runner = ThreadPool()
+webserver.results_dir = os.getenv('RESULTS_DIR', 'results')
+if not os.path.exists(webserver.results_dir):
+    os.makedirs(webserver.results_dir)
+
+# With SERVER_WORKERS > 1 the server is started by api_server.py, which forks that many
+# processes sharing the job registry; they inherit the dataset loaded by the parent
+# (copy-on-write, not a read-only shared mapping: see app/prefork.py)
+webserver.num_workers = int(os.getenv('SERVER_WORKERS', '1'))
+
+# Jobs left unfinished by a previous run are failed by api_server.py on startup, not here:
+# importing the package (the unit tests do) must not touch the jobs of a running server
+webserver.job_registry = JobRegistry(os.getenv('JOB_REGISTRY_PATH', 'jobs.db'))
+webserver.profiler = JobProfiler(job_types=JOB_TYPES)
+webserver.tasks_runner = None
+
+def start_tasks_runner():
+    """Start the thread pool of this process. Forked workers call this after the fork."""
+    webserver.tasks_runner = ThreadPool(webserver.profiler, webserver.job_registry,
+                                        webserver.results_dir)
 
 # webserver.task_runner.start()
 
-webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
+# The dataset is loaded on a background thread so the server can start answering right
+# away. With SERVER_WORKERS > 1 the parent serves on its own until it is loaded, then forks.
+webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv",
+                                       background=True)
 
-webserver.job_counter = 1
+if webserver.num_workers <= 1:
+    start_tasks_runner()
 
 from app import routes
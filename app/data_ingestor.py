@@ -1,15 +1,35 @@
 """DATA INGESTOR"""
-import pandas as pd
+from array import array
+from threading import Thread, Event
+import hashlib
+import math
+import sys
+
+# Optional request filters and the column each of them selects on
+FILTER_COLUMNS = {
+    'states': 'LocationDesc',
+    'stratification_categories': 'StratificationCategory1',
+    'stratifications': 'Stratification1',
+}
 
 class DataIngestor:
     """Class to ingest data from csv file and process it into a dictionary"""
-    def __init__(self, csv_path: str):
-        # Read csv from csv_path
-        df = pd.read_csv(csv_path, usecols=['LocationDesc', 'Question',
-                                            'Data_Value',
-                                            'StratificationCategory1',
-                                            'Stratification1'])
-        self.data = self._process_data(df)
+    def __init__(self, csv_path: str, background: bool = False):
+        self.csv_path = csv_path
+        self.data = None
+        # Hash of the csv contents, identifies the dataset the results were computed on
+        self.version = None
+        # Row store and per-value row bitmaps used to answer filtered requests
+        self.rows = []
+        self.index = {}
+        # (sum, count) of the valid values of every stratum, per (YearStart, YearEnd) period
+        self.partials = {}
+
+        # Loading state, exposed through progress()
+        self.status = "pending"
+        self.rows_total = 0
+        self.rows_processed = 0
+        self.loaded = Event()
 
         self.questions_best_is_min = [
             'Percent of adults aged 18 years and older who have an overweight classification',
@@ -26,15 +46,160 @@ class DataIngestor:
             'Percent of adults who engage in muscle-strengthening activities on 2 or more days a week',
         ]
 
+        if background:
+            Thread(target=self.load, daemon=True).start()
+        else:
+            self.load()
+
+    def load(self):
+        """Read the csv file and build the data dictionary"""
+        try:
+            # pandas is only needed here; importing it lazily keeps server startup fast
+            import pandas as pd  # pylint: disable=import-outside-toplevel
+
+            self.status = "reading"
+            df = pd.read_csv(self.csv_path, usecols=['YearStart', 'YearEnd',
+                                                     'LocationDesc', 'Question',
+                                                     'Data_Value',
+                                                     'StratificationCategory1',
+                                                     'Stratification1'])
+            self.rows_total = len(df)
+            self.status = "processing"
+            self.data = self._process_data(df)
+            self.version = self._hash_file()
+            self.status = "ready"
+        except Exception:
+            self.status = "failed"
+            raise
+        finally:
+            self.loaded.set()
+
+    def wait_ready(self, timeout=None):
+        """Block until loading has finished. Returns True if the data is available."""
+        self.loaded.wait(timeout)
+        return self.status == "ready"
+
+    def is_ready(self):
+        """Check if the data has been loaded"""
+        return self.status == "ready"
+
+    def progress(self):
+        """Report the loading state of the dataset"""
+        return {
+            "status": self.status,
+            "rows_processed": self.rows_processed,
+            "rows_total": self.rows_total,
+            "progress": self.rows_processed / self.rows_total if self.rows_total else 0.0
+        }
+
+    def _hash_file(self):
+        """Hash of the csv file, used as the dataset version"""
+        digest = hashlib.sha256()
+        with open(self.csv_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()[:16]
+
+    def filtered_data(self, question, filters):
+        """Build the data dictionary of question from the rows that match filters.
+
+        filters maps a filter name from FILTER_COLUMNS to the accepted values. The
+        matching rows are found by intersecting the precomputed bitmaps, so only
+        those rows are visited.
+        """
+        # values are grouped by stratum first, so each matching row costs one dict lookup
+        strata = {}
+        for row_id in _bitmap_rows(self._filter_mask(question, filters)):
+            state, _, strat_category, strat_value, data_value = self.rows[row_id]
+            strata.setdefault((state, strat_category, strat_value), []).append(data_value)
+
+        data_dict = {}
+        for (state, strat_category, strat_value), values in strata.items():
+            strat_values = (data_dict.setdefault(state, {})
+                            .setdefault(question, {})
+                            .setdefault(strat_category, {}))
+            strat_values[strat_value] = values
+
+        return data_dict
+
+    def _filter_mask(self, question, filters):
+        """Bitmap of the rows of question that match filters"""
+        mask = self.index['Question'].get(question, 0)
+        for name, accepted in filters.items():
+            allowed = 0
+            for value in accepted:
+                allowed |= self.index[FILTER_COLUMNS[name]].get(value, 0)
+            mask &= allowed
+        return mask
+
+    def year_range_data(self, question, year_range, filters):
+        """Build the data dictionary of question for the periods within year_range.
+
+        year_range is a (first year, last year) pair, either of them may be None. Each
+        stratum of the result is the (sum, count) pre-aggregate of its values, merged
+        from the per-period partials. filters is applied to the partials' keys.
+        """
+        data_dict = {}
+        for state, strat_categories in self._matching_partials(question, filters):
+            for strat_category, strat_values in strat_categories.items():
+                for strat_value, periods in strat_values.items():
+                    merged = [0, 0]
+                    for period, partial in periods.items():
+                        if _in_year_range(period, year_range):
+                            merged[0] += partial[0]
+                            merged[1] += partial[1]
+                    if merged[1]:
+                        strata = (data_dict.setdefault(state, {})
+                                  .setdefault(question, {})
+                                  .setdefault(strat_category, {}))
+                        strata[strat_value] = tuple(merged)
+
+        return data_dict
+
+    def year_partials(self, question, year_range, filters, on_state=None):
+        """(sum, count) of the values of question per period within year_range.
+
+        on_state, if given, is called before each state is merged (to stop a cancelled job).
+        """
+        result = {}
+        for _, strat_categories in self._matching_partials(question, filters):
+            if on_state is not None:
+                on_state()
+            for strat_values in strat_categories.values():
+                for periods in strat_values.values():
+                    for period, (period_sum, period_count) in periods.items():
+                        if _in_year_range(period, year_range):
+                            partial = result.setdefault(period, [0, 0])
+                            partial[0] += period_sum
+                            partial[1] += period_count
+        return result
+
+    def _matching_partials(self, question, filters):
+        """(state, partials of question) pairs, with the strata that don't match filters left out"""
+        for state, questions in self.partials.items():
+            if question not in questions:
+                continue
+            if 'states' in filters and state not in filters['states']:
+                continue
+            strat_categories = {
+                strat_category: {strat_value: periods
+                                 for strat_value, periods in strat_values.items()
+                                 if strat_value in filters.get('stratifications', (strat_value,))}
+                for strat_category, strat_values in questions[question].items()
+                if strat_category in filters.get('stratification_categories', (strat_category,))
+            }
+            yield state, strat_categories
+
     def _process_data(self, df):
         """Process data from csv file into a dictionary"""
         data_dict = {}
-        for _, row in df.iterrows():
-            state = row['LocationDesc']
-            question = row['Question']
-            data_value = row['Data_Value']
-            strat_category = row['StratificationCategory1']
-            strat_value = row['Stratification1']
+        index_columns = ('LocationDesc', 'Question', 'StratificationCategory1', 'Stratification1')
+        row_ids = {column: {} for column in index_columns}
+        # the columns are read once as lists: looking fields up on pandas rows is much slower
+        columns = [df[column].tolist() for column in (*index_columns, 'Data_Value',
+                                                      'YearStart', 'YearEnd')]
+        for row in zip(*columns):
+            state, question, strat_category, strat_value, data_value = row[:5]
 
             if state not in data_dict:
                 data_dict[state] = {}
@@ -49,4 +214,59 @@ class DataIngestor:
                 data_dict[state][question][strat_category][strat_value] = []
             data_dict[state][question][strat_category][strat_value].append(data_value)
 
+            if isinstance(data_value, (int, float)) and not math.isnan(data_value):
+                self._add_to_partials(row)
+
+            row_id = len(self.rows)
+            self.rows.append((state, question, strat_category, strat_value, data_value))
+            for value_rows, value in zip(row_ids.values(), row):
+                # missing (NaN) values can't be filtered on, so they are left out of the index
+                if isinstance(value, str):
+                    value_rows.setdefault(value, []).append(row_id)
+            self.rows_processed += 1
+
+        self.index = {column: {value: _make_bitmap(ids) for value, ids in value_rows.items()}
+                      for column, value_rows in row_ids.items()}
         return data_dict
+
+    def _add_to_partials(self, row):
+        """Add the value of a row to the (sum, count) of its stratum and period"""
+        state, question, strat_category, strat_value, data_value, year_start, year_end = row
+        periods = (self.partials.setdefault(state, {})
+                   .setdefault(question, {})
+                   .setdefault(strat_category, {})
+                   .setdefault(strat_value, {}))
+        partial = periods.setdefault((int(year_start), int(year_end)), [0, 0])
+        partial[0] += data_value
+        partial[1] += 1
+
+
+def _in_year_range(period, year_range):
+    """Check if a (YearStart, YearEnd) period lies within a (first, last) year range"""
+    first_year, last_year = year_range
+    return ((first_year is None or period[0] >= first_year)
+            and (last_year is None or period[1] <= last_year))
+
+
+def _make_bitmap(row_ids):
+    """Pack a list of row ids into an int used as a bitmap"""
+    bits = bytearray((max(row_ids) >> 3) + 1)
+    for row_id in row_ids:
+        bits[row_id >> 3] |= 1 << (row_id & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def _bitmap_rows(bitmap):
+    """Row ids set in a bitmap, in increasing order.
+
+    The bitmap is split into 64 bit words; empty words are skipped and only the set
+    bits of the others are visited.
+    """
+    words = array('Q', bitmap.to_bytes((bitmap.bit_length() + 63) // 64 * 8, 'little'))
+    if sys.byteorder == 'big':
+        words.byteswap()
+    for word_index, word in enumerate(words):
+        while word:
+            lowest = word & -word
+            yield (word_index << 6) + lowest.bit_length() - 1
+            word ^= lowest
@@ -0,0 +1,129 @@
+"""Job Registry Module"""
+from threading import local
+import hashlib
+import os
+import sqlite3
+import time
+
+# Status of a job as every read sees it: a queued job past its deadline is expired,
+# whether or not that has been written down, so that reads never have to write
+STATUS = "CASE WHEN status = 'queued' AND deadline < :now THEN 'expired' ELSE status END"
+
+class JobRegistry:
+    """Job ids, status and queries kept in a SQLite database.
+
+    The database is shared by every server process: job ids come from an
+    AUTOINCREMENT key, so they are unique across processes, and any process can
+    answer for a job submitted to another one. Results stay in the results directory.
+
+    A queued job past its deadline reads as expired (see STATUS) as soon as the
+    deadline passes, without waiting for a worker to dequeue it.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # sqlite connections can't be shared between threads or forked processes
+        self.connections = local()
+        self._connection().executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_type TEXT NOT NULL,
+                query TEXT NOT NULL,
+                status TEXT NOT NULL,
+                dataset_version TEXT,
+                deadline REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_by_query ON jobs (query, status);
+            CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status);
+        ''')
+        # registries created before deadlines were stored
+        columns = {row['name'] for row in self._connection().execute('PRAGMA table_info(jobs)')}
+        if 'deadline' not in columns:
+            self._connection().execute('ALTER TABLE jobs ADD COLUMN deadline REAL')
+
+    def _connection(self):
+        """Connection of the current thread, opened on first use"""
+        if getattr(self.connections, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.row_factory = sqlite3.Row
+            self.connections.conn = conn
+            self.connections.pid = os.getpid()
+        return self.connections.conn
+
+    def create(self, job_type, query, deadline=None):
+        """Register a new queued job and return its id.
+
+        deadline is the time (as in time.time()) after which the job expires if it is
+        still queued, or None.
+        """
+        now = time.time()
+        cursor = self._connection().execute(
+            'INSERT INTO jobs (job_type, query, status, deadline, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)', (job_type, query, 'queued', deadline, now, now))
+        return cursor.lastrowid
+
+    def set_status(self, job_id, status, dataset_version=None, only_from=None):
+        """Update the status of a job, and the dataset version its result was computed on.
+
+        With only_from, the job is only updated if its current status is one of those.
+        Returns True if the job was updated.
+        """
+        query = ('UPDATE jobs SET status = :status, '
+                 'dataset_version = COALESCE(:version, dataset_version), '
+                 'updated_at = :now WHERE id = :id')
+        params = {"status": status, "version": dataset_version, "now": time.time(), "id": job_id}
+        if only_from is not None:
+            names = [f':from{i}' for i in range(len(only_from))]
+            query += f" AND {STATUS} IN ({', '.join(names)})"
+            params.update(zip((name[1:] for name in names), only_from))
+        return self._connection().execute(query, params).rowcount > 0
+
+    def cancel(self, job_id):
+        """Cancel a job that is still queued or running. Returns True if it was cancelled."""
+        return self.set_status(job_id, 'cancelled', only_from=('queued', 'running'))
+
+    def get(self, job_id):
+        """The registry entry of a job as a dict, or None if there is no such job."""
+        row = self._connection().execute(
+            f'SELECT id, job_type, query, {STATUS} AS status, dataset_version, deadline, '
+            'created_at, updated_at FROM jobs WHERE id = :id',
+            {"id": job_id, "now": time.time()}).fetchone()
+        return dict(row) if row is not None else None
+
+    def find_done(self, query, dataset_version):
+        """Ids of finished jobs that computed query on the given dataset, newest first."""
+        rows = self._connection().execute(
+            'SELECT id FROM jobs WHERE query = ? AND status = ? AND dataset_version = ? '
+            'ORDER BY id DESC', (query, 'done', dataset_version)).fetchall()
+        return [row['id'] for row in rows]
+
+    def count(self, status):
+        """Number of jobs with the given status."""
+        # the IN keeps the status index usable: only queued jobs can read differently
+        return self._connection().execute(
+            f"SELECT COUNT(*) FROM jobs WHERE status IN (:status, 'queued') "
+            f"AND {STATUS} = :status", {"status": status, "now": time.time()}).fetchone()[0]
+
+    def list_jobs(self):
+        """Status of every job, by id."""
+        rows = self._connection().execute(f'SELECT id, {STATUS} AS status FROM jobs ORDER BY id',
+                                          {"now": time.time()}).fetchall()
+        return {row['id']: row['status'] for row in rows}
+
+    def fail_unfinished(self):
+        """Mark jobs left queued or running by a previous server run as failed
+        (or as expired, for queued jobs already past their deadline)."""
+        self._connection().execute(
+            "UPDATE jobs SET status = CASE WHEN status = 'queued' AND deadline < :now "
+            "THEN 'expired' ELSE 'error' END, updated_at = :now "
+            "WHERE status IN ('queued', 'running')",
+            {"now": time.time()})
+
+
+def job_etag(job):
+    """ETag of the result of a registry entry, from the dataset version and the query."""
+    if job is None or job['dataset_version'] is None:
+        return None
+    return hashlib.sha1(f"{job['dataset_version']}:{job['query']}".encode('utf-8')).hexdigest()
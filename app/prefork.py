@@ -0,0 +1,84 @@
+"""Pre-forking Server Module"""
+import gc
+import os
+import signal
+import socket
+from threading import Thread
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+
+class _ClosingRequestHandler(WSGIRequestHandler):
+    """One request per connection, so that no kept-alive connection holds up the fork"""
+    protocol_version = "HTTP/1.0"
+
+
+def serve(app, num_workers, address, init_worker, warm_up=None):
+    """Serve app from num_workers forked processes accepting on one shared socket.
+
+    Everything the parent loaded before calling this (the dataset in particular) starts
+    out shared with the workers through the fork, copy-on-write. This is not a read-only
+    shared mapping and the sharing does not last: in CPython even reading an object
+    updates its reference count, which writes to its page, so each worker gradually
+    ends up with a private copy of the pages it reads. gc.freeze() only keeps the
+    garbage collector from adding to that. What the fork saves is loading the data once.
+    Each worker calls init_worker() once forked, to start the threads that did not
+    survive the fork.
+
+    warm_up is an optional (until_ready, before_fork) pair of callables. With it, the
+    parent itself serves app on the socket until until_ready() returns, so that the
+    server answers (its readiness probe in particular) while the dataset is still
+    loading. It then stops serving, waits for the requests in flight and calls
+    before_fork() to stop what it started for them (its thread pool).
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+    listener.listen(128)
+    listener.set_inheritable(True)
+
+    if warm_up is not None:
+        until_ready, before_fork = warm_up
+        _serve_until(app, address, listener, until_ready)
+        before_fork()
+
+    gc.freeze()
+
+    children = []
+    for _ in range(num_workers):
+        pid = os.fork()
+        if pid == 0:
+            init_worker()
+            server = make_server(*address, app, threaded=True, fd=listener.fileno())
+            server.serve_forever()
+            os._exit(0)
+        children.append(pid)
+
+    def stop_children(signum, _frame):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop_children)
+    signal.signal(signal.SIGINT, stop_children)
+
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+
+def _serve_until(app, address, listener, until_ready):
+    """Serve app on listener from a thread of this process until until_ready() returns."""
+    server = make_server(*address, app, threaded=True, fd=listener.fileno(),
+                         request_handler=_ClosingRequestHandler)
+    # lets server_close() wait for the requests in flight
+    server.daemon_threads = False
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    until_ready()
+    server.shutdown()
+    thread.join()
+    server.server_close()
@@ -0,0 +1,140 @@
+"""Job Profiler Module"""
+from threading import Thread, Event, Lock, get_ident
+import cProfile
+import os
+import sys
+
+PROFILE_MODES = ('cprofile', 'sample')
+
+
+class JobProfiler:
+    """Profiles job execution on demand, for the next N jobs and/or a given job type.
+
+    In 'cprofile' mode the job runs under cProfile and the stats are dumped as a
+    pstats file. In 'sample' mode a sampler thread records the worker's stack at a
+    fixed interval and the samples are written as collapsed stacks (flame graph input).
+    """
+    def __init__(self, output_dir='profiles', sample_interval=0.001, job_types=None):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        # the job types enable() accepts, any if None
+        self.job_types = job_types
+        # checked without the lock so that jobs pay nothing while profiling is off
+        self.enabled = False
+        self.lock = Lock()
+        self.settings = {"mode": "cprofile", "job_type": None, "remaining": None}
+        # cProfile can't have two active profilers at once, so profiled jobs take turns
+        self.cprofile_lock = Lock()
+
+    def enable(self, num_jobs=None, job_type=None, mode='cprofile'):
+        """Profile the next num_jobs jobs (all jobs if None), optionally only of job_type."""
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profiling mode {mode}")
+        if num_jobs is not None and (isinstance(num_jobs, bool) or not isinstance(num_jobs, int)
+                                     or num_jobs <= 0):
+            raise ValueError("num_jobs must be a positive integer")
+        if job_type is not None and self.job_types is not None and job_type not in self.job_types:
+            raise ValueError(f"Unknown job type {job_type}")
+        with self.lock:
+            self.settings = {"mode": mode, "job_type": job_type, "remaining": num_jobs}
+            self.enabled = True
+
+    def disable(self):
+        """Stop profiling new jobs."""
+        with self.lock:
+            self.enabled = False
+
+    def is_armed(self, job_type):
+        """Check, without claiming anything, if jobs of job_type are being profiled."""
+        if not self.enabled:
+            return False
+        with self.lock:
+            return self.enabled and self.settings["job_type"] in (None, job_type)
+
+    def claim(self, job_type):
+        """Return the profiling mode if the job should be profiled, None otherwise."""
+        if not self.enabled:
+            return None
+        with self.lock:
+            if not self.enabled:
+                return None
+            if self.settings["job_type"] not in (None, job_type):
+                return None
+            if self.settings["remaining"] is not None:
+                self.settings["remaining"] -= 1
+                if self.settings["remaining"] <= 0:
+                    self.enabled = False
+            return self.settings["mode"]
+
+    def profile(self, job_id, mode, func, *args):
+        """Run func(*args) under the given profiling mode and store the profile of job_id."""
+        if mode == 'cprofile':
+            with self.cprofile_lock:
+                profiler = cProfile.Profile()
+                result = profiler.runcall(func, *args)
+            temp_path = os.path.join(self.output_dir, f'.job_id_{job_id}.pstats')
+            profiler.dump_stats(temp_path)
+            os.rename(temp_path, os.path.join(self.output_dir, f'job_id_{job_id}.pstats'))
+            return result
+
+        samples = {}
+        done = Event()
+        # set only while func runs, so that starting and joining the sampler isn't sampled
+        in_job = Event()
+        entry_frame = sys._getframe()  # pylint: disable=protected-access
+        sampler = Thread(target=self._sample,
+                         args=(get_ident(), entry_frame, samples, (in_job, done)), daemon=True)
+        sampler.start()
+        try:
+            in_job.set()
+            result = func(*args)
+        finally:
+            in_job.clear()
+            done.set()
+            sampler.join()
+
+        self._write_samples(job_id, samples)
+        return result
+
+    def _write_samples(self, job_id, samples):
+        """Store the sampled stacks of job_id as collapsed stacks."""
+        temp_path = os.path.join(self.output_dir, f'.job_id_{job_id}.collapsed')
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            for stack, count in sorted(samples.items()):
+                file.write(f"{stack} {count}\n")
+        os.rename(temp_path, os.path.join(self.output_dir, f'job_id_{job_id}.collapsed'))
+
+    def _sample(self, thread_id, entry_frame, samples, events):
+        """Sample the stack of thread_id below entry_frame while in_job is set, until done is."""
+        in_job, done = events
+        while not done.wait(self.sample_interval):
+            if not in_job.is_set():
+                continue
+            frame = sys._current_frames().get(thread_id)  # pylint: disable=protected-access
+            stack = []
+            while frame is not None and frame is not entry_frame:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                             f":{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                samples[key] = samples.get(key, 0) + 1
+
+    def status(self):
+        """Current profiling settings and the jobs that have a profile available."""
+        with self.lock:
+            status = dict(self.settings, enabled=self.enabled)
+        status["profiles"] = sorted(name for name in os.listdir(self.output_dir)
+                                    if not name.startswith('.'))
+        return status
+
+    def profile_path(self, job_id, profile_format):
+        """Path of the stored profile of job_id, or None if there is none."""
+        extension = 'pstats' if profile_format == 'pstats' else 'collapsed'
+        path = os.path.join(self.output_dir, f'{job_id}.{extension}')
+        if os.path.exists(path):
+            return path
+        return None
@@ -1,8 +1,24 @@
 """routes"""
 import os
 import json
-from flask import request, jsonify
+import time
+from flask import request, jsonify, send_file
 from app import webserver
+from app.task_runner import normalize_query
+from app.data_ingestor import FILTER_COLUMNS
+from app.job_registry import job_etag
+
+@webserver.after_request
+def add_etag(response):
+    """Tag successful GET responses by their content and answer If-None-Match with 304"""
+    if request.method == 'GET' and response.status_code == 200 and not response.direct_passthrough:
+        if response.get_etag() == (None, None):
+            response.add_etag()
+        # not make_conditional: it sets a Date header on top of the one the server sends
+        etag, _ = response.get_etag()
+        if request.if_none_match.contains_weak(etag):
+            response.status_code = 304
+    return response
 
 # Example endpoint definition
 @webserver.route('/api/post_endpoint', methods=['POST'])
@@ -20,10 +36,35 @@ def post_endpoint():
 
 @webserver.route('/api/num_jobs', methods=['GET'])
 def get_num_jobs():
-    """Get the number of jobs left in the queue"""
-    num_jobs_left = webserver.tasks_runner.queue.qsize()
+    """Get the number of jobs left in the queue, and of the jobs dropped from it,
+    across all server processes"""
+    num_jobs_left = webserver.job_registry.count('queued')
 
-    return jsonify({"jobs_left": num_jobs_left})
+    return jsonify({"jobs_left": num_jobs_left,
+                    "cancelled": webserver.job_registry.count('cancelled'),
+                    "expired": webserver.job_registry.count('expired')})
+
+@webserver.route('/api/jobs', methods=['GET'])
+def get_jobs():
+    """List all job ids and their status"""
+    jobs = webserver.job_registry.list_jobs()
+
+    return jsonify({f'job_id_{job_id}': status for job_id, status in jobs.items()})
+
+@webserver.route('/api/ready', methods=['GET'])
+def ready():
+    """Readiness probe reporting the dataset loading progress"""
+    progress = webserver.data_ingestor.progress()
+    progress["ready"] = webserver.data_ingestor.is_ready()
+
+    if progress["ready"]:
+        return jsonify(progress)
+    return jsonify(progress), 503
+
+@webserver.route('/api/pool', methods=['GET'])
+def get_pool_stats():
+    """Get the current size, limits and resize events of the worker pool"""
+    return jsonify(webserver.tasks_runner.stats())
 
 @webserver.route('/api/graceful_shutdown', methods=['GET'])
 def graceful_shutdown():
@@ -33,145 +74,195 @@ def graceful_shutdown():
         return jsonify({"message": "Shutdown initiated"})
     return jsonify({"message": "Shutdown already initiated"})
 
+@webserver.route('/api/admin/profiling', methods=['GET', 'POST', 'DELETE'])
+def profiling():
+    """Turn job profiling on (POST) or off (DELETE), or get its status (GET)"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({"status": "error", "message": "Expected a JSON object"}), 400
+        try:
+            webserver.profiler.enable(num_jobs=data.get('num_jobs'),
+                                      job_type=data.get('job_type'),
+                                      mode=data.get('mode', 'cprofile'))
+        except ValueError as err:
+            return jsonify({"status": "error", "message": str(err)}), 400
+    elif request.method == 'DELETE':
+        webserver.profiler.disable()
+
+    return jsonify(webserver.profiler.status())
+
+@webserver.route('/api/admin/profiles/<job_id>', methods=['GET'])
+def get_profile(job_id):
+    """Download the profile of a job, as pstats or as collapsed stacks"""
+    profile_format = request.args.get('format', 'pstats')
+    profile_path = webserver.profiler.profile_path(job_id, profile_format)
+
+    if profile_path is None:
+        return jsonify({"status": "error", "message": "No profile for this job"}), 404
+    return send_file(os.path.abspath(profile_path), as_attachment=True,
+                     mimetype='application/octet-stream' if profile_format == 'pstats'
+                     else 'text/plain')
+
+def get_job(job_id):
+    """Registry entry of a job_id of the form job_id_<n>, or None"""
+    if job_id.startswith('job_id_') and job_id[len('job_id_'):].isdigit():
+        return webserver.job_registry.get(int(job_id[len('job_id_'):]))
+    return None
+
+@webserver.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a queued or running job"""
+    job = get_job(job_id)
+
+    if job is None:
+        return jsonify({"status": "error", "message": "Job ID not found"}), 404
+    if not webserver.job_registry.cancel(job['id']):
+        job = webserver.job_registry.get(job['id'])
+        return jsonify({"status": job['status'], "message": "Job already finished"}), 409
+    return jsonify({"status": "cancelled"})
+
 @webserver.route('/api/get_results/<job_id>', methods=['GET'])
 def get_response(job_id):
     """Get the results of a job with the given job_id"""
     print(f"JobID is {job_id}")
 
-    results_path = os.path.join('results/', f'{job_id}')
+    job = get_job(job_id)
 
-    if not os.path.exists(results_path):
-        id = int(results_path.split('_')[2])
-        if id < webserver.job_counter:
-            return jsonify({
-            "status": "running",
-        })
-        else:
-            return jsonify({
+    if job is None:
+        return jsonify({
             "status": "error",
             "message": "Job ID not found"
         })
+    if job['status'] != 'done':
+        # queued jobs are reported as running, as they always were
+        response = {"status": 'running' if job['status'] == 'queued' else job['status']}
+        if job['status'] == 'error':
+            response["message"] = "Job failed"
+        return jsonify(response)
+
+    results_path = os.path.join(webserver.results_dir, f'{job_id}')
     try:
         with open(results_path, 'r') as file:
             result_data = json.load(file)
-            return jsonify({
+            response = jsonify({
                 "status": "done",
-                "data": result_data  
+                "data": result_data
             })
+            etag = job_etag(job)
+            if etag is not None:
+                response.set_etag(etag)
+            return response
+    except FileNotFoundError:
+        return jsonify({"status": "error", "message": "Result no longer available"})
     except json.JSONDecodeError:
         return jsonify({"status": "error", "message": "Failed to decode result data"}), 500
 
-@webserver.route('/api/states_mean', methods=['POST'])
-def states_mean_request():
-    """Endpoint to get the mean of all states"""
-    # Get request data
+def validate_request(data):
+    """Check the optional deadline, year range and filters of a request.
+
+    Returns an error message, or None if the request is valid.
+    """
+    if not isinstance(data, dict):
+        return "the request body must be a JSON object"
+
+    deadline = data.get('deadline')
+    if deadline is not None and (isinstance(deadline, bool)
+                                 or not isinstance(deadline, (int, float)) or deadline <= 0):
+        return "deadline must be a positive number of seconds"
+
+    for name in ('year_start', 'year_end'):
+        year = data.get(name)
+        if year is not None and (isinstance(year, bool) or not isinstance(year, int)):
+            return f"{name} must be a year"
+
+    for name in FILTER_COLUMNS:
+        accepted = data.get(name)
+        if accepted is not None and not (
+                isinstance(accepted, str) or (isinstance(accepted, list)
+                                              and all(isinstance(value, str)
+                                                      for value in accepted))):
+            return f"{name} must be a string or a list of strings"
+    return None
+
+def submit_job(job_type):
+    """Queue a job for the request data and return its job_id.
+
+    A query whose result is already known (same normalized request, same dataset)
+    reuses the existing job instead of creating new work, unless jobs of this type are
+    being profiled.
+    """
     data = request.json
 
-    # Register job. Don't wait for task to finish
-    # Increment job_id counter
-    # Return associated job_id
+    error = validate_request(data)
+    if error is not None:
+        return jsonify({"status": "error", "message": error}), 400
+
+    query = normalize_query(job_type, data)
 
-    job_id = webserver.job_counter
-    webserver.tasks_runner.queue.put((job_id, data, "states_mean", webserver.data_ingestor))
-    webserver.job_counter += 1
+    # a job about to be profiled has to run, even if its result is already known
+    done_jobs = ([] if webserver.profiler.is_armed(job_type)
+                 else webserver.job_registry.find_done(query, webserver.data_ingestor.version))
+    for job_id in done_jobs:
+        if os.path.exists(os.path.join(webserver.results_dir, f'job_id_{job_id}')):
+            break
+    else:
+        deadline = data.get('deadline')
+        job_id = webserver.job_registry.create(
+            job_type, query, None if deadline is None else time.time() + deadline)
+        webserver.tasks_runner.add_job((job_id, data, job_type, webserver.data_ingestor))
 
     return jsonify({"job_id": 'job_id_'+str(job_id)})
 
+@webserver.route('/api/states_mean', methods=['POST'])
+def states_mean_request():
+    """Endpoint to get the mean of all states"""
+    return submit_job("states_mean")
+
 @webserver.route('/api/state_mean', methods=['POST'])
 def state_mean_request():
     """Endpoint to get the mean of a specific state"""
-
-    data = request.json
-
-    job_id = webserver.job_counter
-    webserver.tasks_runner.queue.put((job_id, data, "state_mean", webserver.data_ingestor))
-    webserver.job_counter += 1
-
-    return jsonify({"job_id": 'job_id_'+str(job_id)})
+    return submit_job("state_mean")
 
 @webserver.route('/api/best5', methods=['POST'])
 def best5_request():
     """Endpoint to get the best 5 states for a given question"""
-
-    data = request.json
-
-    job_id = webserver.job_counter
-    webserver.tasks_runner.queue.put((job_id, data, "best5", webserver.data_ingestor))
-    webserver.job_counter += 1
-
-    return jsonify({"job_id": 'job_id_'+str(job_id)})
+    return submit_job("best5")
 
 @webserver.route('/api/worst5', methods=['POST'])
 def worst5_request():
     """Endpoint to get the worst 5 states for a given question"""
-    data = request.json
-
-    job_id = webserver.job_counter
-    webserver.tasks_runner.queue.put((job_id, data, "worst5", webserver.data_ingestor))
-    webserver.job_counter += 1
-
-    return jsonify({"job_id": 'job_id_'+str(job_id)})
+    return submit_job("worst5")
 
 @webserver.route('/api/global_mean', methods=['POST'])
 def global_mean_request():
     """Endpoint to get the global mean of a given question"""
-    data = request.json
-
-    job_id = webserver.job_counter
-    webserver.tasks_runner.queue.put((job_id, data, "global_mean", webserver.data_ingestor))
-    webserver.job_counter += 1
-
-    return jsonify({"job_id": 'job_id_'+str(job_id)})
+    return submit_job("global_mean")
 
 @webserver.route('/api/diff_from_mean', methods=['POST'])
 def diff_from_mean_request():
     """Endpoint to get the difference of a state from the global mean for a given question"""
-
-    data = request.json
-
-    job_id = webserver.job_counter
-    webserver.tasks_runner.queue.put((job_id, data, "diff_from_mean", webserver.data_ingestor))
-    webserver.job_counter += 1
-
-    return jsonify({"job_id": 'job_id_'+str(job_id)})
+    return submit_job("diff_from_mean")
 
 @webserver.route('/api/state_diff_from_mean', methods=['POST'])
 def state_diff_from_mean_request():
     """Endpoint to get the difference of a state from the global mean for a given question"""
-
-    data = request.json
-
-    job_id = webserver.job_counter
-    webserver.tasks_runner.queue.put((job_id, data, "state_diff_from_mean",
-                                      webserver.data_ingestor))
-    webserver.job_counter += 1
-
-    return jsonify({"job_id": 'job_id_'+str(job_id)})
+    return submit_job("state_diff_from_mean")
 
 @webserver.route('/api/mean_by_category', methods=['POST'])
 def mean_by_category_request():
     """Endpoint to get the mean of a category for a given question"""
-
-    data = request.json
-
-    job_id = webserver.job_counter
-    webserver.tasks_runner.queue.put((job_id, data, "mean_by_category", webserver.data_ingestor))
-    webserver.job_counter += 1
-
-    return jsonify({"job_id": 'job_id_'+str(job_id)})
+    return submit_job("mean_by_category")
 
 @webserver.route('/api/state_mean_by_category', methods=['POST'])
 def state_mean_by_category_request():
     """Endpoint to get the mean of a category for a given question for a specific state"""
+    return submit_job("state_mean_by_category")
 
-    data = request.json
-
-    job_id = webserver.job_counter
-    webserver.tasks_runner.queue.put((job_id, data, "state_mean_by_category",
-                                      webserver.data_ingestor))
-    webserver.job_counter += 1
-
-    return jsonify({"job_id": 'job_id_'+str(job_id)})
+@webserver.route('/api/mean_by_year', methods=['POST'])
+def mean_by_year_request():
+    """Endpoint to get the mean of a given question for each year, optionally for one state"""
+    return submit_job("mean_by_year")
 
 @webserver.route('/')
 @webserver.route('/index')
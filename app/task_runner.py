@@ -1,39 +1,193 @@
 """Task Runner Module"""
-from queue import Queue
+from collections import deque
+from queue import Queue, Empty
 from threading import Thread, Event, Lock
 import os
+import time
 import json
 import tempfile
+import traceback
 import math
+from app.data_ingestor import FILTER_COLUMNS
+
+# Job types compute_job knows, one per statistics endpoint
+JOB_TYPES = ('states_mean', 'state_mean', 'best5', 'worst5', 'global_mean', 'diff_from_mean',
+             'state_diff_from_mean', 'mean_by_category', 'state_mean_by_category',
+             'mean_by_year')
+
+# Shortest pause between two checks of the supervisor, whatever TP_SCALE_UP_WAIT is
+MIN_SUPERVISE_INTERVAL = 0.01
+# Shortest pause between two looks at the job registry for the cancellation of a running job
+CANCEL_CHECK_INTERVAL = 0.01
 
 class ThreadPool:
-    """Thread Pool"""
-    def __init__(self):
+    """Elastic Thread Pool
+
+    Starts with min_threads workers and adds one (up to max_threads) whenever the
+    oldest queued job has been waiting longer than scale_up_wait seconds while every
+    worker is busy. Workers idle for idle_timeout seconds retire, down to min_threads.
+    """
+    def __init__(self, profiler=None, registry=None, results_dir='results'):
 
         self.queue = Queue()
         self.threads = []
-        self.graceful_shutdown = Event()
-        self.num_of_threads = os.getenv('TP_NUM_OF_THREADS', os.cpu_count())
-
-        for _ in range(self.num_of_threads):
-            thread = TaskRunner(self.queue)
-            thread.start()
-            self.threads.append(thread)
-
+        self.shutdown_event = Event()
+        self.lock = Lock()
+        self.profiler = profiler
+        self.registry = registry
+        self.results_dir = results_dir
+        self.busy_threads = 0
+        self.resize_events = deque(maxlen=100)
+
+        max_threads = int(os.getenv('TP_MAX_THREADS',
+                                    os.getenv('TP_NUM_OF_THREADS', os.cpu_count())))
+        self.limits = {
+            "min_threads": max(1, min(int(os.getenv('TP_MIN_THREADS', '1')), max_threads)),
+            "max_threads": max_threads,
+            "idle_timeout": float(os.getenv('TP_IDLE_TIMEOUT', '30')),
+            "scale_up_wait": float(os.getenv('TP_SCALE_UP_WAIT', '0.05')),
+        }
+
+        with self.lock:
+            for _ in range(self.limits["min_threads"]):
+                self._start_thread("startup")
+
+        Thread(target=self._supervise, daemon=True).start()
+
+    def _start_thread(self, reason):
+        """Start a new worker. Must be called with the lock held."""
+        thread = TaskRunner(self)
+        thread.start()
+        self.threads.append(thread)
+        self._record_resize("grow", reason)
+
+    def _record_resize(self, event, reason):
+        """Remember a resize event. Must be called with the lock held."""
+        self.resize_events.append({"time": time.time(), "event": event,
+                                   "reason": reason, "size": len(self.threads)})
+
+    def _supervise(self):
+        """Grow the pool while jobs wait in the queue and no worker is free."""
+        interval = max(self.limits["scale_up_wait"] / 2, MIN_SUPERVISE_INTERVAL)
+        while not self.shutdown_event.wait(interval):
+            try:
+                self._grow_if_waiting()
+            except Exception:  # pylint: disable=broad-exception-caught
+                # e.g. the job registry being unavailable: try again on the next round
+                traceback.print_exc()
+
+    def _grow_if_waiting(self):
+        """Add a worker if the oldest pending job waited too long and every worker is busy."""
+        wait = self.queue_wait()
+        with self.lock:
+            if (wait > self.limits["scale_up_wait"]
+                    and self.busy_threads >= len(self.threads)
+                    and len(self.threads) < self.limits["max_threads"]
+                    and not self.shutdown_event.is_set()):
+                self._start_thread(f"queue wait {wait:.3f}s")
+
+    def queue_wait(self):
+        """How long the oldest queued job that will still run has been waiting, in seconds.
+
+        Stop markers and jobs cancelled or expired while queued are skipped: more
+        workers would not make them run.
+        """
+        with self.queue.mutex:
+            items = list(self.queue.queue)
+        now = time.monotonic()
+        for item in items:
+            if item is not None and self.is_pending(item, now):
+                return now - item[0]
+        return 0.0
+
+    def is_pending(self, item, now):
+        """Check if a queued item is a job that is still waiting to run."""
+        enqueued_at, (job_id, job_data, _, _) = item
+        deadline = job_data.get('deadline')
+        if deadline is not None and now - enqueued_at > deadline:
+            return False
+        if self.registry is None:
+            return True
+        # the deadline is in job_data, the registry is only read (no write) for cancellations
+        job = self.registry.get(job_id)
+        return job is not None and job['status'] == 'queued'
+
+    def retire(self, thread):
+        """Called by an idle worker. Returns True if the worker should exit."""
+        with self.lock:
+            if len(self.threads) <= self.limits["min_threads"]:
+                return False
+            self.threads.remove(thread)
+            self._record_resize("shrink", f"idle for {self.limits['idle_timeout']}s")
+            return True
+
+    def set_busy(self, busy):
+        """Track how many workers are running a job."""
+        with self.lock:
+            self.busy_threads += 1 if busy else -1
+
+    def stats(self):
+        """Current size, limits and recent resize events of the pool."""
+        # measured before taking the lock: it may read the job registry
+        wait = self.queue_wait()
+        with self.lock:
+            return dict(self.limits, size=len(self.threads), busy=self.busy_threads,
+                        queue_wait=wait, events=list(self.resize_events))
 
     def add_job(self, job):
         """Add a job to the ThreadPool."""
-        self.queue.put(job)
+        self.queue.put((time.monotonic(), job))
 
     def graceful_shutdown(self):
         """Gracefully shutdown the ThreadPool."""
-        self.graceful_shutdown.set()
-        for thread in self.threads:
+        with self.lock:
+            self.shutdown_event.set()
+            threads = list(self.threads)
+            # one stop marker per worker, queued behind the jobs that are still pending
+            for _ in threads:
+                self.queue.put(None)
+        for thread in threads:
             thread.join()
 
     def is_shutdown(self):
         """Check if the ThreadPool is in the process of shutting down."""
-        return self.graceful_shutdown.is_set()
+        return self.shutdown_event.is_set()
+
+
+def is_number(value):
+    """Values that the mean computations accept."""
+    return isinstance(value, (int, float))
+
+
+def is_valid_value(value):
+    """Values that are neither missing nor NaN."""
+    return value is not None and not (isinstance(value, float) and math.isnan(value))
+
+
+def stratum_sum_count(stratum, keep):
+    """Sum and count of the values of a stratum that pass keep.
+
+    A stratum is either the list of its raw values or, for year range queries, the
+    (sum, count) pre-aggregate of its valid values.
+    """
+    if isinstance(stratum, tuple):
+        return stratum
+    valid_values = [value for value in stratum if keep(value)]
+    return sum(valid_values), len(valid_values)
+
+
+def question_sum_count(strat_categories, keep):
+    """Sum and count of the values that pass keep over all the strata of a question."""
+    all_values = []
+    total_sum, total_count = 0, 0
+    for strat_values in strat_categories.values():
+        for stratum in strat_values.values():
+            if isinstance(stratum, tuple):
+                total_sum += stratum[0]
+                total_count += stratum[1]
+            else:
+                all_values.extend([v for v in stratum if keep(v)])
+    return total_sum + sum(all_values), total_count + len(all_values)
 
 
 def calculate_states_mean(data, question):
@@ -41,13 +195,10 @@ def calculate_states_mean(data, question):
     result = {}
     for state, questions in data.items():
         if question in questions:
-            all_values = []
-            for strat_category in questions[question].values():
-                for values in strat_category.values():
-                    all_values.extend([v for v in values if v is not None])
-
-            if all_values:
-                result[state] = sum(all_values) / len(all_values)
+            total_sum, total_count = question_sum_count(questions[question],
+                                                        lambda v: v is not None)
+            if total_count:
+                result[state] = total_sum / total_count
 
     sorted_result = dict(sorted(result.items(), key=lambda item: item[1]))
     return sorted_result
@@ -57,12 +208,10 @@ def calculate_state_mean(data, question, state):
     """Calculate the mean value for a given question and state."""
     result = {}
     if state in data and question in data[state]:
-        all_values = []
-        for strat_category in data[state][question].values():
-            for values in strat_category.values():
-                all_values.extend([v for v in values if v is not None])
-        if all_values:
-            result[state] = sum(all_values) / len(all_values)
+        total_sum, total_count = question_sum_count(data[state][question],
+                                                    lambda v: v is not None)
+        if total_count:
+            result[state] = total_sum / total_count
 
     return result
 
@@ -71,13 +220,10 @@ def calculate_best5(data, question, questions_best_is_max):
     result = {}
     for state, questions in data.items():
         if question in questions:
-            all_values = []
-            for strat_category in questions[question].values():
-                for strat_values in strat_category.values():
-                    all_values.extend([v for v in strat_values if isinstance(v, (int, float))])
+            total_sum, total_count = question_sum_count(questions[question], is_number)
 
-            if all_values:
-                mean_value = sum(all_values) / len(all_values)
+            if total_count:
+                mean_value = total_sum / total_count
                 result[state] = mean_value
 
     is_reverse = True if question in questions_best_is_max else False
@@ -93,13 +239,10 @@ def calculate_worst5(data, question, questions_best_is_min):
     result = {}
     for state, questions in data.items():
         if question in questions:
-            all_values = []
-            for strat_category in questions[question].values():
-                for strat_values in strat_category.values():
-                    all_values.extend([v for v in strat_values if isinstance(v, (int, float))])
+            total_sum, total_count = question_sum_count(questions[question], is_number)
 
-            if all_values:
-                mean_value = sum(all_values) / len(all_values)
+            if total_count:
+                mean_value = total_sum / total_count
                 result[state] = mean_value
 
     is_reverse = True if question in questions_best_is_min else False
@@ -114,14 +257,13 @@ def calculate_global_mean(data, question):
     total_sum = 0
     total_count = 0
 
-    for state, questions in data.items():
+    for questions in data.values():
         if question in questions:
             for strat_category in questions[question].values():
                 for strat_values in strat_category.values():
-                    valid_values = [value for value in strat_values
-                                    if isinstance(value, (int, float))]
-                    total_sum += sum(valid_values)
-                    total_count += len(valid_values)
+                    values_sum, values_count = stratum_sum_count(strat_values, is_number)
+                    total_sum += values_sum
+                    total_count += values_count
 
     if total_count > 0:
         return {"global_mean": total_sum / total_count}
@@ -135,13 +277,10 @@ def calculate_diff_from_mean(data, question):
     result = {}
     for state, questions in data.items():
         if question in questions:
-            all_values = []
-            for strat_category in questions[question].values():
-                for strat_values in strat_category.values():
-                    all_values.extend([v for v in strat_values if isinstance(v, (int, float))])
+            total_sum, total_count = question_sum_count(questions[question], is_number)
 
-            if all_values:
-                mean_value = sum(all_values) / len(all_values)
+            if total_count:
+                mean_value = total_sum / total_count
                 result[state] = global_mean - mean_value
 
     return result
@@ -153,13 +292,10 @@ def calculate_state_diff_from_mean(data, question, state):
 
     state_mean = None
     if state in data and question in data[state]:
-        all_values = []
-        for strat_category in data[state][question].values():
-            for strat_values in strat_category.values():
-                all_values.extend([v for v in strat_values if isinstance(v, (int, float))])
+        total_sum, total_count = question_sum_count(data[state][question], is_number)
 
-        if all_values:
-            state_mean = sum(all_values) / len(all_values)
+        if total_count:
+            state_mean = total_sum / total_count
 
 
     if state_mean is not None and global_mean is not None:
@@ -177,10 +313,9 @@ def calculate_mean_by_category(data, question):
                 for strat_value, values in strat_values.items():
                     if strat_value is None or strat_value == '' or str(strat_value).lower() == 'nan':
                         continue
-                    valid_values = [value for value in values if value is not
-                                    None and not (isinstance(value, float) and math.isnan(value))]
-                    if valid_values:
-                        mean_value = sum(valid_values) / len(valid_values)
+                    values_sum, values_count = stratum_sum_count(values, is_valid_value)
+                    if values_count:
+                        mean_value = values_sum / values_count
                         key = f"('{state}', '{strat_category}', '{strat_value}')"
                         result[key] = mean_value
     return result
@@ -192,60 +327,235 @@ def calculate_state_mean_by_category(data, question, state):
     if state in data and question in data[state]:
         for strat_category, strat_values in data[state][question].items():
             for strat_value, values in strat_values.items():
-                valid_values = [value for value in values if isinstance(value, (int, float))]
-                if valid_values:
-                    mean_value = sum(valid_values) / len(valid_values)
+                values_sum, values_count = stratum_sum_count(values, is_number)
+                if values_count:
+                    mean_value = values_sum / values_count
                     key_str = f"('{strat_category}', '{strat_value}')"
                     state_result[key_str] = mean_value
 
     return {state: state_result}
 
 
+def calculate_mean_by_year(year_partials):
+    """Calculate the mean value of each period from its (sum, count) pre-aggregate."""
+    result = {}
+    for (year_start, year_end), (values_sum, values_count) in sorted(year_partials.items()):
+        if values_count:
+            label = str(year_start) if year_start == year_end else f"{year_start}-{year_end}"
+            result[label] = values_sum / values_count
+    return result
+
+
+
+class JobCancelled(Exception):
+    """Raised inside a job that was cancelled while it was running."""
+
+
+class CancellableData(dict):
+    """Data dictionary of a running job that checks for cancellation once created and
+    then on every state the computation goes over, so that a cancelled job stops mid-way."""
+    def __init__(self, data, is_cancelled):
+        super().__init__(data)
+        self.is_cancelled = is_cancelled
+        self._check()
+
+    def _check(self):
+        if self.is_cancelled():
+            raise JobCancelled()
+
+    def items(self):
+        for item in super().items():
+            self._check()
+            yield item
+
+    def values(self):
+        for value in super().values():
+            self._check()
+            yield value
+
+
+def get_filters(job_data):
+    """Extract the optional row filters (see FILTER_COLUMNS) from the request data."""
+    filters = {}
+    for name in FILTER_COLUMNS:
+        accepted = job_data.get(name)
+        if accepted is None:
+            continue
+        if isinstance(accepted, str):
+            accepted = [accepted]
+        filters[name] = set(accepted)
+    return filters
+
+
+def normalize_query(job_type, job_data):
+    """Canonical form of a request: only the fields that affect the result, in a fixed order."""
+    query = {name: job_data[name] for name in ('question', 'state', 'year_start', 'year_end')
+             if job_data.get(name) is not None}
+    for name, accepted in get_filters(job_data).items():
+        query[name] = sorted(accepted)
+    return job_type + ':' + json.dumps(query, sort_keys=True, separators=(',', ':'))
+
+
+def select_data(data_ingestor, question, year_range, filters):
+    """The data dictionary a job works on: the whole dataset, or only the rows (or, for a
+    year range, the per-period pre-aggregates) that the request selects."""
+    if year_range != (None, None):
+        return data_ingestor.year_range_data(question, year_range, filters)
+    if filters:
+        return data_ingestor.filtered_data(question, filters)
+    return data_ingestor.data
+
+
+def compute_job(job_type, job_data, data_ingestor, is_cancelled=None):
+    """Compute the result of a job of the given type.
+
+    is_cancelled is checked after the data is selected and then on every state the
+    computation goes over; the job stops with JobCancelled as soon as it returns True.
+    """
+    result = None
+
+    filters = get_filters(job_data)
+    year_range = (job_data.get('year_start'), job_data.get('year_end'))
+
+    if job_type == 'mean_by_year':
+        if 'state' in job_data:
+            # narrows down the states filter of the request, if there is one
+            filters['states'] = filters.get('states', {job_data['state']}) & {job_data['state']}
+        def on_state():
+            if is_cancelled is not None and is_cancelled():
+                raise JobCancelled()
+
+        return calculate_mean_by_year(
+            data_ingestor.year_partials(job_data['question'], year_range, filters, on_state))
+
+    data = select_data(data_ingestor, job_data['question'], year_range, filters)
+
+    if is_cancelled is not None:
+        data = CancellableData(data, is_cancelled)
+
+    if job_type == 'states_mean':
+        result = calculate_states_mean(data, job_data['question'])
+    elif job_type == 'state_mean':
+        result = calculate_state_mean(data, job_data['question'],
+                                      job_data['state'])
+    elif job_type == 'best5':
+        result = calculate_best5(data, job_data['question'],
+                                 data_ingestor.questions_best_is_max)
+    elif job_type == 'worst5':
+        result = calculate_worst5(data, job_data['question'],
+                                  data_ingestor.questions_best_is_min)
+    elif job_type == 'global_mean':
+        result = calculate_global_mean(data, job_data['question'])
+    elif job_type == 'diff_from_mean':
+        result = calculate_diff_from_mean(data, job_data['question'])
+    elif job_type == 'state_diff_from_mean':
+        result = calculate_state_diff_from_mean(data,
+                                                job_data['question'], job_data['state'])
+    elif job_type == 'mean_by_category':
+        result = calculate_mean_by_category(data,
+                                            job_data['question'])
+    elif job_type == 'state_mean_by_category':
+        result = calculate_state_mean_by_category(data,
+                                                  job_data['question'], job_data['state'])
+    return result
+
 
 class TaskRunner(Thread):
     """Threaded Task Runner"""
-    def __init__(self, q: Queue):
-        if not os.path.exists('results'):
-            os.makedirs('results')
-        super().__init__()
-        self.queue = q
+    def __init__(self, pool: ThreadPool):
+        if not os.path.exists(pool.results_dir):
+            os.makedirs(pool.results_dir)
+        super().__init__(daemon=True)
+        self.pool = pool
+        self.queue = pool.queue
+        self.profiler = pool.profiler
 
     def run(self):
         while True:
-            job_id, job_data, job_type, data_ingestor = self.queue.get()
-            result = None
-
-            if job_type == 'states_mean':
-                result = calculate_states_mean(data_ingestor.data, job_data['question'])
-            elif job_type == 'state_mean':
-                result = calculate_state_mean(data_ingestor.data, job_data['question'],
-                                              job_data['state'])
-            elif job_type == 'best5':
-                result = calculate_best5(data_ingestor.data, job_data['question'],
-                                         data_ingestor.questions_best_is_max)
-            elif job_type == 'worst5':
-                result = calculate_worst5(data_ingestor.data, job_data['question'],
-                                          data_ingestor.questions_best_is_min)
-            elif job_type == 'global_mean':
-                result = calculate_global_mean(data_ingestor.data, job_data['question'])
-            elif job_type == 'diff_from_mean':
-                result = calculate_diff_from_mean(data_ingestor.data, job_data['question'])
-            elif job_type == 'state_diff_from_mean':
-                result = calculate_state_diff_from_mean(data_ingestor.data,
-                                                        job_data['question'], job_data['state'])
-            elif job_type == 'mean_by_category':
-                result = calculate_mean_by_category(data_ingestor.data,
-                                                    job_data['question'])
-            elif job_type == 'state_mean_by_category':
-                result = calculate_state_mean_by_category(data_ingestor.data,
-                                                          job_data['question'], job_data['state'])
-
-            # did this to make sure the file is written before it will be read - rename is atomic
-
-            temp_file_path = tempfile.mktemp(dir='results')
-            with open(temp_file_path, 'w') as temp_file:
-                json.dump(result, temp_file)
-
-            os.rename(temp_file_path, f'results/job_id_{job_id}')
-            self.queue.task_done()
-            
\ No newline at end of file
+            try:
+                item = self.queue.get(timeout=self.pool.limits["idle_timeout"])
+            except Empty:
+                if self.pool.retire(self):
+                    return
+                continue
+
+            if item is None:
+                # stop marker put by graceful_shutdown
+                self.queue.task_done()
+                return
+
+            # a worker waiting for the dataset to load isn't busy: more workers wouldn't help
+            item[1][3].wait_ready()
+            self.pool.set_busy(True)
+            try:
+                self.run_job(item[0], *item[1])
+            except JobCancelled:
+                pass
+            except Exception:  # pylint: disable=broad-exception-caught
+                # a failing job must not take the worker down with it
+                traceback.print_exc()
+                self.set_status(item[1][0], 'error', only_from=('queued', 'running'))
+            finally:
+                self.pool.set_busy(False)
+                self.queue.task_done()
+
+    def set_status(self, job_id, status, dataset_version=None, only_from=None):
+        """Record the status of a job in the job registry, if there is one.
+
+        Returns False if the registry refused the change (see JobRegistry.set_status).
+        """
+        if self.pool.registry is None:
+            return True
+        return self.pool.registry.set_status(job_id, status, dataset_version, only_from)
+
+    def is_cancelled(self, job_id):
+        """Check if the job was cancelled through the job registry."""
+        if self.pool.registry is None:
+            return False
+        job = self.pool.registry.get(job_id)
+        return job is not None and job['status'] == 'cancelled'
+
+    def run_job(self, enqueued_at, job_id, job_data, job_type, data_ingestor):
+        """Compute a job and write its result to the results directory."""
+        if not data_ingestor.wait_ready():
+            self.set_status(job_id, 'error', only_from=('queued',))
+            return
+
+        deadline = job_data.get('deadline')
+        if deadline is not None and time.monotonic() - enqueued_at > deadline:
+            self.set_status(job_id, 'expired', only_from=('queued',))
+            return
+
+        # fails if the job was cancelled while it was queued
+        if not self.set_status(job_id, 'running', only_from=('queued',)):
+            return
+
+        next_check = [0.0]
+
+        def cancelled():
+            # called for every state: look at the registry at most every CANCEL_CHECK_INTERVAL
+            now = time.monotonic()
+            if now < next_check[0]:
+                return False
+            next_check[0] = now + CANCEL_CHECK_INTERVAL
+            return self.is_cancelled(job_id)
+
+        profile_mode = self.profiler.claim(job_type) if self.profiler else None
+        if profile_mode:
+            result = self.profiler.profile(job_id, profile_mode, compute_job,
+                                           job_type, job_data, data_ingestor, cancelled)
+        else:
+            result = compute_job(job_type, job_data, data_ingestor, cancelled)
+
+        if self.is_cancelled(job_id):
+            raise JobCancelled()
+
+        # did this to make sure the file is written before it will be read - rename is atomic
+
+        temp_file_path = tempfile.mktemp(dir=self.pool.results_dir)
+        with open(temp_file_path, 'w') as temp_file:
+            json.dump(result, temp_file)
+
+        os.rename(temp_file_path, os.path.join(self.pool.results_dir, f'job_id_{job_id}'))
+        self.set_status(job_id, 'done', data_ingestor.version, only_from=('running',))
+        
\ No newline at end of file
@@ -3,10 +3,49 @@ import os
 import unittest
 import json
 import unittest
+import tempfile
+import time
+import sqlite3
+import pandas as pd
+from threading import Event, current_thread, main_thread
+from unittest import mock
 sys.path.append('./unittests')
 
-from app.data_ingestor import DataIngestor
-from app.task_runner import calculate_diff_from_mean, calculate_global_mean, calculate_state_diff_from_mean, calculate_states_mean, calculate_state_mean, calculate_worst5, calculate_mean_by_category, calculate_best5, calculate_state_mean_by_category
+# keep the job registry and the results of the tests away from those of a server running
+# next to them: the tests' job ids would otherwise overwrite (or be served as) its results.
+# The thread pools the tests start themselves get a results directory of their own.
+TEST_DIR = tempfile.mkdtemp()
+os.environ.setdefault('JOB_REGISTRY_PATH', os.path.join(TEST_DIR, 'jobs.db'))
+os.environ.setdefault('RESULTS_DIR', os.path.join(TEST_DIR, 'results'))
+
+from app import webserver
+from app.data_ingestor import DataIngestor, _bitmap_rows
+from app.job_registry import JobRegistry
+from app.profiler import JobProfiler
+from app.task_runner import ThreadPool, JobCancelled
+from app.task_runner import calculate_diff_from_mean, calculate_global_mean, calculate_state_diff_from_mean, calculate_states_mean, calculate_state_mean, calculate_worst5, calculate_mean_by_category, calculate_best5, calculate_state_mean_by_category, compute_job, normalize_query
+
+class GatedIngestor(DataIngestor):
+    """DataIngestor whose background load waits until the test opens the gate"""
+    gate = None
+
+    def load(self):
+        self.gate.wait()
+        super().load()
+
+
+class BlockingIngestor(DataIngestor):
+    """DataIngestor whose year partials are only returned once the test releases them"""
+    release = None
+
+    def year_partials(self, question, year_range, filters, on_state=None):
+        self.release.wait()
+        return super().year_partials(question, year_range, filters, on_state)
+
+
+POOL_ENV = {"TP_MIN_THREADS": "1", "TP_MAX_THREADS": "3",
+            "TP_SCALE_UP_WAIT": "0.02", "TP_IDLE_TIMEOUT": "0.2"}
+
 
 class TestWebserver(unittest.TestCase):
 
@@ -15,6 +54,25 @@ class TestWebserver(unittest.TestCase):
         self.data_ingestor = DataIngestor(csv_path)
         self.data = self.data_ingestor.data
 
+    def wait_for_status(self, client, job_id, timeout=5):
+        """Poll get_results until the job is no longer running."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            response = client.get(f"/api/get_results/{job_id}").get_json()
+            if response["status"] != "running":
+                return response
+            time.sleep(0.05)
+        self.fail(f"Job {job_id} still running after {timeout}s")
+
+    def wait_for_pool_size(self, pool, size, timeout=5):
+        """Poll the pool stats until the pool has the given number of workers."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if pool.stats()["size"] == size:
+                return
+            time.sleep(0.01)
+        self.fail(f"Pool size is {pool.stats()['size']}, expected {size}")
+
     def read_expected_output(self, test_type, filename):
         """Utility method to read the expected output JSON from a file based on test type."""
         base_path = os.path.dirname(os.path.dirname(__file__))
@@ -157,6 +215,575 @@ class TestWebserver(unittest.TestCase):
         else:
             self.fail(f"State {request_data['state']} not found in result")
 
+
+    def test_states_mean_filtered(self):
+        request_data = {"question": "Percent of adults aged 18 years and older who have an overweight classification",
+                        "states": ["Ohio", "Texas"], "stratification_categories": ["Age (years)"]}
+        result = compute_job("states_mean", request_data, self.data_ingestor)
+
+        self.assertEqual(set(result.keys()), {"Ohio", "Texas"})
+        for state, value in result.items():
+            values = [v for strat_values in self.data[state][request_data["question"]]["Age (years)"].values()
+                      for v in strat_values]
+            self.assertAlmostEqual(value, sum(values) / len(values), places=5)
+
+    def test_global_mean_filtered_by_stratification(self):
+        request_data = {"question": "Percent of adults aged 18 years and older who have an overweight classification",
+                        "stratifications": ["18 - 24"]}
+        result = compute_job("global_mean", request_data, self.data_ingestor)
+
+        values = [v for questions in self.data.values() if request_data["question"] in questions
+                  for strat_values in questions[request_data["question"]].values()
+                  for v in strat_values.get("18 - 24", [])]
+        self.assertAlmostEqual(result["global_mean"], sum(values) / len(values), places=5)
+
+    def test_filter_without_matches(self):
+        request_data = {"question": "Percent of adults aged 18 years and older who have an overweight classification",
+                        "states": ["Atlantis"]}
+        self.assertEqual(compute_job("states_mean", request_data, self.data_ingestor), {})
+
+
+    def test_normalize_query(self):
+        question = "Percent of adults aged 18 years and older who have obesity"
+        first = normalize_query("states_mean", {"question": question, "states": ["Utah", "Ohio"]})
+        second = normalize_query("states_mean", {"states": ["Ohio", "Utah", "Ohio"], "question": question})
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, normalize_query("best5", {"question": question, "states": ["Utah", "Ohio"]}))
+        self.assertNotEqual(first, normalize_query("states_mean", {"question": question}))
+
+
+    def test_job_registry(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            registry = JobRegistry(os.path.join(tmp_dir, "jobs.db"))
+            first = registry.create("states_mean", "query")
+            second = registry.create("states_mean", "query")
+            self.assertNotEqual(first, second)
+            self.assertEqual(registry.get(first)["status"], "queued")
+
+            registry.set_status(first, "done", "v1")
+            self.assertEqual(registry.find_done("query", "v1"), [first])
+            self.assertEqual(registry.find_done("query", "v2"), [])
+            self.assertEqual(registry.count("queued"), 1)
+
+    def test_job_registry_transitions(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            registry = JobRegistry(os.path.join(tmp_dir, "jobs.db"))
+            job_id = registry.create("states_mean", "query")
+            self.assertTrue(registry.set_status(job_id, "running", only_from=("queued",)))
+            # a job only starts once
+            self.assertFalse(registry.set_status(job_id, "running", only_from=("queued",)))
+            self.assertTrue(registry.cancel(job_id))
+            self.assertFalse(registry.cancel(job_id))
+            # a worker finishing a cancelled job doesn't overwrite the cancellation
+            self.assertFalse(registry.set_status(job_id, "done", "v1", only_from=("running",)))
+            self.assertEqual(registry.get(job_id)["status"], "cancelled")
+            self.assertEqual(registry.find_done("query", "v1"), [])
+
+    def test_job_registry_expires_overdue_jobs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            registry = JobRegistry(os.path.join(tmp_dir, "jobs.db"))
+            overdue = registry.create("states_mean", "query", deadline=time.time() - 1)
+            pending = registry.create("states_mean", "query", deadline=time.time() + 60)
+            no_deadline = registry.create("states_mean", "query")
+            self.assertEqual(registry.count("queued"), 2)
+            self.assertEqual(registry.count("expired"), 1)
+            self.assertEqual(registry.list_jobs(), {overdue: "expired", pending: "queued",
+                                                    no_deadline: "queued"})
+            self.assertFalse(registry.cancel(overdue))
+            self.assertFalse(registry.set_status(overdue, "running", only_from=("queued",)))
+
+            # reads don't write: they go on while another connection holds the write lock
+            writer = sqlite3.connect(os.path.join(tmp_dir, "jobs.db"), isolation_level=None)
+            writer.execute("BEGIN IMMEDIATE")
+            try:
+                self.assertEqual(registry.get(overdue)["status"], "expired")
+                self.assertEqual(registry.count("expired"), 1)
+                self.assertEqual(len(registry.list_jobs()), 3)
+            finally:
+                writer.execute("ROLLBACK")
+                writer.close()
+
+            # the deadline only applies while the job is queued
+            running = registry.create("states_mean", "query", deadline=time.time() + 0.05)
+            registry.set_status(running, "running", only_from=("queued",))
+            time.sleep(0.1)
+            self.assertEqual(registry.get(running)["status"], "running")
+
+
+    def test_year_range_covering_all_years(self):
+        request_data = {"question": "Percent of adults aged 18 years and older who have an overweight classification"}
+        expected = compute_job("states_mean", request_data, self.data_ingestor)
+        result = compute_job("states_mean", dict(request_data, year_start=2011, year_end=2022),
+                             self.data_ingestor)
+
+        self.assertEqual(set(result.keys()), set(expected.keys()))
+        for state, value in expected.items():
+            self.assertAlmostEqual(result[state], value, places=5)
+
+    def test_mean_by_year_matches_year_range(self):
+        request_data = {"question": "Percent of adults aged 18 years and older who have an overweight classification",
+                        "state": "Ohio"}
+        series = compute_job("mean_by_year", request_data, self.data_ingestor)
+
+        self.assertTrue(series)
+        for year, value in series.items():
+            year_mean = compute_job("state_mean", dict(request_data, year_start=int(year), year_end=int(year)),
+                                    self.data_ingestor)
+            self.assertAlmostEqual(year_mean["Ohio"], value, places=5)
+
+    def test_mean_by_year_state_narrows_states_filter(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        ohio = compute_job("mean_by_year", {"question": question, "state": "Ohio"},
+                           self.data_ingestor)
+
+        self.assertEqual(compute_job("mean_by_year", {"question": question, "state": "Ohio",
+                                                      "states": ["Ohio", "Texas"]},
+                                     self.data_ingestor), ohio)
+        self.assertEqual(compute_job("mean_by_year", {"question": question, "state": "Ohio",
+                                                      "states": ["Texas"]},
+                                     self.data_ingestor), {})
+
+    def test_year_range_with_filters(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        request_data = {"question": question, "year_start": 2014, "year_end": 2019,
+                        "states": ["Ohio", "Texas"], "stratifications": ["18 - 24", "Total"]}
+        df = pd.read_csv("unittests/nutrition.csv")
+        df = df[(df["Question"] == question) & (df["YearStart"] >= 2014) & (df["YearEnd"] <= 2019)
+                & df["LocationDesc"].isin(request_data["states"])
+                & df["Stratification1"].isin(request_data["stratifications"])]
+
+        result = compute_job("global_mean", request_data, self.data_ingestor)
+        self.assertAlmostEqual(result["global_mean"], df["Data_Value"].mean(), places=5)
+
+        result = compute_job("states_mean", request_data, self.data_ingestor)
+        expected = df.groupby("LocationDesc")["Data_Value"].mean()
+        self.assertEqual(set(result.keys()), set(expected.index))
+        for state, value in expected.items():
+            self.assertAlmostEqual(result[state], value, places=5)
+
+        result = compute_job("mean_by_year", request_data, self.data_ingestor)
+        expected = df.groupby("YearStart")["Data_Value"].mean()
+        self.assertEqual(set(result.keys()), {str(year) for year in expected.index})
+        for year, value in expected.items():
+            self.assertAlmostEqual(result[str(year)], value, places=5)
+
+    def test_mean_by_year_endpoint(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        client = webserver.test_client()
+        for request_data in ({"question": question, "year_start": "2015"},
+                             {"question": question, "year_end": 2015.5},
+                             {"question": question, "year_start": True}):
+            response = client.post("/api/mean_by_year", json=request_data)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()["status"], "error")
+
+        request_data = {"question": question, "state": "Ohio", "year_start": 2014,
+                        "year_end": 2019, "stratifications": ["Total"]}
+        previous_ingestor, webserver.data_ingestor = webserver.data_ingestor, self.data_ingestor
+        try:
+            response = client.post("/api/mean_by_year", json=request_data)
+            self.assertEqual(response.status_code, 200)
+            response = self.wait_for_status(client, response.get_json()["job_id"])
+        finally:
+            webserver.data_ingestor = previous_ingestor
+        self.assertEqual(response["status"], "done")
+        expected = compute_job("mean_by_year", request_data, self.data_ingestor)
+        self.assertTrue(expected)
+        self.assertEqual(set(response["data"].keys()), set(expected.keys()))
+        for year, value in expected.items():
+            self.assertAlmostEqual(response["data"][year], value, places=5)
+
+
+    def test_ready_probe_and_jobs_queued_during_loading(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        GatedIngestor.gate = Event()
+        loading_ingestor = GatedIngestor("unittests/nutrition.csv", background=True)
+        previous_ingestor, webserver.data_ingestor = webserver.data_ingestor, loading_ingestor
+        try:
+            client = webserver.test_client()
+            response = client.get("/api/ready")
+            self.assertEqual(response.status_code, 503)
+            self.assertFalse(response.get_json()["ready"])
+
+            job_id = client.post("/api/states_mean", json={"question": question}).get_json()["job_id"]
+            self.assertEqual(client.get(f"/api/get_results/{job_id}").get_json()["status"], "running")
+
+            GatedIngestor.gate.set()
+            self.assertTrue(loading_ingestor.wait_ready(timeout=30))
+            response = client.get("/api/ready")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()["progress"], 1.0)
+
+            result = self.wait_for_status(client, job_id)
+            self.assertEqual(result["status"], "done")
+            expected = calculate_states_mean(self.data, question)
+            for state, value in expected.items():
+                self.assertAlmostEqual(result["data"][state], value, places=5)
+        finally:
+            GatedIngestor.gate.set()
+            webserver.data_ingestor = previous_ingestor
+
+    def test_failed_load(self):
+        failed_ingestor = DataIngestor("unittests/missing.csv", background=True)
+        self.assertFalse(failed_ingestor.wait_ready(timeout=30))
+        self.assertEqual(failed_ingestor.progress()["status"], "failed")
+
+        previous_ingestor, webserver.data_ingestor = webserver.data_ingestor, failed_ingestor
+        try:
+            client = webserver.test_client()
+            response = client.get("/api/ready")
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.get_json()["status"], "failed")
+
+            job_id = client.post("/api/states_mean", json={"question": "q"}).get_json()["job_id"]
+            self.assertEqual(self.wait_for_status(client, job_id)["status"], "error")
+        finally:
+            webserver.data_ingestor = previous_ingestor
+
+
+    def test_profile_next_jobs_of_type(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        work_dir = tempfile.mkdtemp()
+        profiler = JobProfiler(output_dir=os.path.join(work_dir, 'profiles'))
+        registry = JobRegistry(os.path.join(work_dir, 'jobs.db'))
+        profiler.enable(num_jobs=2, job_type='states_mean')
+
+        pool = ThreadPool(profiler, registry, os.path.join(work_dir, 'results'))
+        job_ids = {}
+        for job_type in ('global_mean', 'states_mean', 'global_mean', 'states_mean',
+                         'states_mean', 'global_mean'):
+            job_id = registry.create(job_type, job_type)
+            job_ids[job_id] = job_type
+            pool.add_job((job_id, {"question": question}, job_type, self.data_ingestor))
+        pool.graceful_shutdown()
+
+        profiled = {int(name.split('.')[0][len('job_id_'):]) for name in profiler.status()["profiles"]}
+        self.assertEqual(len(profiled), 2)
+        self.assertTrue(all(job_ids[job_id] == 'states_mean' for job_id in profiled))
+        self.assertFalse(profiler.status()["enabled"])
+        self.assertIsNone(profiler.claim('states_mean'))
+
+
+    def test_pool_grows_on_queue_wait_and_retires_idle_workers(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        BlockingIngestor.release = Event()
+        blocking_ingestor = BlockingIngestor("unittests/nutrition.csv")
+        with mock.patch.dict(os.environ, POOL_ENV):
+            pool = ThreadPool(results_dir=tempfile.mkdtemp())
+        try:
+            for job_id in range(5):
+                pool.add_job((job_id, {"question": question}, 'mean_by_year', blocking_ingestor))
+            self.wait_for_pool_size(pool, 3)
+            # never more than TP_MAX_THREADS, however long the queue waits
+            time.sleep(0.1)
+            stats = pool.stats()
+            self.assertEqual(stats["size"], 3)
+            self.assertEqual(stats["busy"], 3)
+            self.assertTrue(all(event["reason"].startswith("queue wait")
+                                for event in stats["events"][1:]))
+
+            BlockingIngestor.release.set()
+            self.wait_for_pool_size(pool, 1)
+            self.assertEqual(pool.stats()["events"][-1]["event"], "shrink")
+        finally:
+            BlockingIngestor.release.set()
+            pool.graceful_shutdown()
+
+    def test_pool_supervisor_survives_errors(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        BlockingIngestor.release = Event()
+        blocking_ingestor = BlockingIngestor("unittests/nutrition.csv")
+        with mock.patch.dict(os.environ, POOL_ENV):
+            pool = ThreadPool(results_dir=tempfile.mkdtemp())
+        queue_wait = pool.queue_wait
+        failures = []
+
+        def failing_queue_wait():
+            # only the supervisor's calls fail, not the test's own through stats()
+            if len(failures) < 3 and current_thread() is not main_thread():
+                failures.append(True)
+                raise sqlite3.OperationalError("database is locked")
+            return queue_wait()
+
+        try:
+            with mock.patch.object(pool, "queue_wait", side_effect=failing_queue_wait), \
+                    mock.patch("traceback.print_exc"):
+                for job_id in range(3):
+                    pool.add_job((job_id, {"question": question}, 'mean_by_year',
+                                  blocking_ingestor))
+                self.wait_for_pool_size(pool, 3)
+            self.assertEqual(len(failures), 3)
+        finally:
+            BlockingIngestor.release.set()
+            pool.graceful_shutdown()
+
+    def test_pool_does_not_grow_while_loading(self):
+        GatedIngestor.gate = Event()
+        loading_ingestor = GatedIngestor("unittests/nutrition.csv", background=True)
+        with mock.patch.dict(os.environ, POOL_ENV):
+            pool = ThreadPool(results_dir=tempfile.mkdtemp())
+        try:
+            for job_id in range(3):
+                pool.add_job((job_id, {"question": "q"}, 'states_mean', loading_ingestor))
+            time.sleep(0.2)
+            self.assertEqual(pool.stats()["size"], 1)
+            self.assertEqual(pool.stats()["busy"], 0)
+        finally:
+            GatedIngestor.gate.set()
+            pool.graceful_shutdown()
+
+    def test_pool_limits(self):
+        with mock.patch.dict(os.environ, {"TP_MIN_THREADS": "5", "TP_MAX_THREADS": "2",
+                                          "TP_SCALE_UP_WAIT": "0"}):
+            pool = ThreadPool(results_dir=tempfile.mkdtemp())
+        try:
+            self.assertEqual(pool.stats()["min_threads"], 2)
+            self.assertEqual(pool.stats()["size"], 2)
+        finally:
+            pool.graceful_shutdown()
+
+        with mock.patch.dict(os.environ, {"TP_MIN_THREADS": "0", "TP_MAX_THREADS": "2"}):
+            pool = ThreadPool(results_dir=tempfile.mkdtemp())
+        try:
+            self.assertEqual(pool.stats()["min_threads"], 1)
+            self.assertEqual(pool.stats()["size"], 1)
+        finally:
+            pool.graceful_shutdown()
+
+    def test_pool_endpoint(self):
+        response = webserver.test_client().get("/api/pool")
+        self.assertEqual(response.status_code, 200)
+        stats = response.get_json()
+        for key in ("size", "busy", "min_threads", "max_threads", "queue_wait", "events"):
+            self.assertIn(key, stats)
+        self.assertTrue(stats["min_threads"] <= stats["size"] <= stats["max_threads"])
+        self.assertEqual(stats["events"][0]["reason"], "startup")
+
+
+    def test_bitmap_rows(self):
+        for row_ids in ([], [0], [3, 63, 64, 65], list(range(0, 1000, 7)), list(range(200))):
+            bitmap = sum(1 << row_id for row_id in row_ids)
+            self.assertEqual(list(_bitmap_rows(bitmap)), row_ids)
+
+    def test_selective_filter_visits_only_matching_rows(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        states = list(self.data_ingestor.index['LocationDesc'])
+        matching = [row_id for row_id, row in enumerate(self.data_ingestor.rows)
+                    if row[0] == states[0] and row[1] == question]
+        all_rows = [row_id for row_id, row in enumerate(self.data_ingestor.rows)
+                    if row[1] == question]
+
+        def visited_rows(filters):
+            visited = []
+
+            def counting_rows(bitmap):
+                for row_id in _bitmap_rows(bitmap):
+                    visited.append(row_id)
+                    yield row_id
+
+            with mock.patch("app.data_ingestor._bitmap_rows", side_effect=counting_rows):
+                self.data_ingestor.filtered_data(question, filters)
+            return visited
+
+        self.assertEqual(visited_rows({"states": {states[0]}}), matching)
+        self.assertEqual(visited_rows({"states": set(states)}), all_rows)
+        self.assertLess(len(matching), len(all_rows))
+
+    def test_invalid_filters_rejected(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        client = webserver.test_client()
+        for states in (5, ["Ohio", 1], [["Ohio"]], {"Ohio": True}):
+            response = client.post("/api/states_mean", json={"question": question,
+                                                             "states": states})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()["status"], "error")
+
+        for body in ([1, 2], "Ohio", 5):
+            response = client.post("/api/states_mean", json=body)
+            self.assertEqual(response.status_code, 400)
+
+        for states in ("Ohio", ["Ohio", "Texas"]):
+            response = client.post("/api/states_mean", json={"question": question,
+                                                             "states": states})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("job_id", response.get_json())
+
+
+    def test_etag_not_modified(self):
+        client = webserver.test_client()
+        response = client.get("/api/num_jobs")
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        # the server adds the Date header, the application must not add another one
+        self.assertNotIn("Date", response.headers)
+
+        response = client.get("/api/num_jobs", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+        self.assertNotIn("Date", response.headers)
+
+        response = client.get("/api/num_jobs", headers={"If-None-Match": '"other"'})
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_cancel_endpoint(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        client = webserver.test_client()
+        self.assertEqual(client.delete("/api/jobs/job_id_999999").status_code, 404)
+        self.assertEqual(client.delete("/api/jobs/unknown").status_code, 404)
+
+        # registered but never queued, so it stays queued until it is cancelled
+        queued = webserver.job_registry.create("states_mean", "cancel test")
+        response = client.delete(f"/api/jobs/job_id_{queued}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["status"], "cancelled")
+        self.assertEqual(client.get(f"/api/get_results/job_id_{queued}").get_json()["status"],
+                         "cancelled")
+        self.assertEqual(client.delete(f"/api/jobs/job_id_{queued}").status_code, 409)
+
+        previous_ingestor, webserver.data_ingestor = webserver.data_ingestor, self.data_ingestor
+        try:
+            job_id = client.post("/api/global_mean",
+                                 json={"question": question}).get_json()["job_id"]
+            self.assertEqual(self.wait_for_status(client, job_id)["status"], "done")
+        finally:
+            webserver.data_ingestor = previous_ingestor
+        response = client.delete(f"/api/jobs/{job_id}")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()["status"], "done")
+
+    def test_deadline_expires_queued_job(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        GatedIngestor.gate = Event()
+        loading_ingestor = GatedIngestor("unittests/nutrition.csv", background=True)
+        previous_ingestor, webserver.data_ingestor = webserver.data_ingestor, loading_ingestor
+        try:
+            client = webserver.test_client()
+            expired_before = client.get("/api/num_jobs").get_json()["expired"]
+            job_id = client.post("/api/states_mean", json={"question": question,
+                                                           "deadline": 0.05}).get_json()["job_id"]
+            time.sleep(0.1)
+            # expired while still queued, no worker has looked at it yet
+            self.assertEqual(client.get(f"/api/get_results/{job_id}").get_json()["status"],
+                             "expired")
+            self.assertEqual(client.get("/api/num_jobs").get_json()["expired"],
+                             expired_before + 1)
+
+            GatedIngestor.gate.set()
+            self.assertTrue(loading_ingestor.wait_ready(timeout=30))
+            webserver.tasks_runner.queue.join()
+            self.assertEqual(client.get(f"/api/get_results/{job_id}").get_json()["status"],
+                             "expired")
+        finally:
+            GatedIngestor.gate.set()
+            webserver.data_ingestor = previous_ingestor
+
+    def test_queue_wait_skips_dead_jobs(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        BlockingIngestor.release = Event()
+        blocking_ingestor = BlockingIngestor("unittests/nutrition.csv")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            registry = JobRegistry(os.path.join(tmp_dir, "jobs.db"))
+            with mock.patch.dict(os.environ, dict(POOL_ENV, TP_MAX_THREADS="1")):
+                pool = ThreadPool(registry=registry, results_dir=tmp_dir)
+            try:
+                # keeps the only worker busy
+                running = registry.create("mean_by_year", "running")
+                pool.add_job((running, {"question": question}, 'mean_by_year', blocking_ingestor))
+                cancelled = registry.create("states_mean", "cancelled")
+                pool.add_job((cancelled, {"question": question}, 'states_mean', blocking_ingestor))
+                expired = registry.create("states_mean", "expired", deadline=time.time() + 0.01)
+                pool.add_job((expired, {"question": question, "deadline": 0.01},
+                              'states_mean', blocking_ingestor))
+                registry.cancel(cancelled)
+                time.sleep(0.05)
+                self.assertEqual(pool.queue_wait(), 0.0)
+
+                pending = registry.create("states_mean", "pending")
+                pool.add_job((pending, {"question": question}, 'states_mean', blocking_ingestor))
+                time.sleep(0.05)
+                self.assertGreater(pool.queue_wait(), 0.0)
+            finally:
+                BlockingIngestor.release.set()
+                pool.graceful_shutdown()
+            self.assertEqual(registry.list_jobs(), {running: "done", cancelled: "cancelled",
+                                                    expired: "expired", pending: "done"})
+
+    def test_running_job_stops_when_cancelled(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        checks = []
+
+        def is_cancelled():
+            checks.append(True)
+            return len(checks) > 2
+
+        for job_type in ('states_mean', 'global_mean', 'diff_from_mean', 'mean_by_category',
+                         'mean_by_year'):
+            checks.clear()
+            with self.assertRaises(JobCancelled):
+                compute_job(job_type, {"question": question}, self.data_ingestor, is_cancelled)
+            self.assertEqual(len(checks), 3)
+
+        self.assertIsNotNone(compute_job('states_mean', {"question": question},
+                                         self.data_ingestor, lambda: False))
+
+
+    def test_profiling_settings_validated(self):
+        client = webserver.test_client()
+        for settings in ({"num_jobs": [1]}, {"num_jobs": {"n": 1}}, {"num_jobs": "2"},
+                         {"num_jobs": 0}, {"num_jobs": True}, {"job_type": "states_means"},
+                         {"mode": "trace"}, [1, 2]):
+            response = client.post("/api/admin/profiling", json=settings)
+            self.assertEqual(response.status_code, 400)
+            self.assertFalse(client.get("/api/admin/profiling").get_json()["enabled"])
+
+        response = client.post("/api/admin/profiling", json={"num_jobs": 2,
+                                                             "job_type": "states_mean"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["remaining"], 2)
+        client.delete("/api/admin/profiling")
+
+
+    def test_profiling_skips_cached_results(self):
+        question = "Percent of adults aged 18 years and older who have an overweight classification"
+        client = webserver.test_client()
+        previous_ingestor, webserver.data_ingestor = webserver.data_ingestor, self.data_ingestor
+        try:
+            first = client.post("/api/best5", json={"question": question}).get_json()["job_id"]
+            self.assertEqual(self.wait_for_status(client, first)["status"], "done")
+            # known result: the job is reused
+            self.assertEqual(client.post("/api/best5", json={"question": question})
+                             .get_json()["job_id"], first)
+
+            client.post("/api/admin/profiling", json={"num_jobs": 1, "job_type": "best5"})
+            profiled = client.post("/api/best5", json={"question": question}).get_json()["job_id"]
+            self.assertNotEqual(profiled, first)
+            self.assertEqual(self.wait_for_status(client, profiled)["status"], "done")
+            self.assertIn(f"{profiled}.pstats", client.get("/api/admin/profiling")
+                          .get_json()["profiles"])
+            self.assertFalse(client.get("/api/admin/profiling").get_json()["enabled"])
+        finally:
+            webserver.data_ingestor = previous_ingestor
+            webserver.profiler.disable()
+
+
+    def test_sample_profile_only_has_job_frames(self):
+        def busy_job():
+            deadline = time.perf_counter() + 0.1
+            while time.perf_counter() < deadline:
+                pass
+            return "result"
+
+        output_dir = os.path.join(tempfile.mkdtemp(), 'profiles')
+        profiler = JobProfiler(output_dir=output_dir)
+        self.assertEqual(profiler.profile(7, 'sample', busy_job), "result")
+        with open(os.path.join(output_dir, 'job_id_7.collapsed'), encoding='utf-8') as file:
+            stacks = [line.rsplit(' ', 1)[0] for line in file]
+        self.assertTrue(stacks)
+        # every sample is taken inside the job, none in the sampler's own start/join
+        self.assertTrue(all(stack.startswith('busy_job ') for stack in stacks), stacks)
+
     
 
 if __name__ == '__main__':